@@ -30,6 +30,9 @@ setup(
         "Topic :: System :: Recovery Tools"
     ],
     python_requires='>=3.8',
+    extras_require={
+        'blake3': ['blake3']
+    },
     entry_points={
         'console_scripts': ['winshatag=winshatag:main']
     }
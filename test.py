@@ -18,6 +18,7 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import hashlib
 import os
 import winshatag
 
@@ -82,6 +83,179 @@ os.utime(filename, ns=(ts, ts))
 exitcode = winshatag.main([filename])
 assert exitcode == 5
 
+print("*** Trusting the modification date of corrupt file ***")
+exitcode = winshatag.main(['--trust-mtime', filename])
+assert exitcode == 0
+
+print("*** Testing file read in several chunks ***")
+# Shrink the limits so that a small file goes through the reader thread.
+mmap_max_size, chunk_size = winshatag.MMAP_MAX_SIZE, winshatag.CHUNK_SIZE
+winshatag.MMAP_MAX_SIZE, winshatag.CHUNK_SIZE = 1000, 4096
+chunked_filename = 'chunked.txt'
+data = bytes(range(256)) * 100 + b'tail'
+
+try:
+    os.unlink(chunked_filename)
+except FileNotFoundError:
+    pass
+
+with open(chunked_filename, 'wb') as f:
+    f.write(data)
+
+exitcode = winshatag.main([chunked_filename])
+assert exitcode == 0
+assert winshatag.getStoredSha256(
+    chunked_filename) == hashlib.sha256(data).hexdigest()
+
+winshatag.MMAP_MAX_SIZE, winshatag.CHUNK_SIZE = mmap_max_size, chunk_size
+os.unlink(chunked_filename)
+
+print("*** Modifying file before its result is reported ***")
+late_filename = 'late.txt'
+
+try:
+    os.unlink(late_filename)
+except FileNotFoundError:
+    pass
+
+open(late_filename, 'w').close()
+
+result = winshatag.scanFile(late_filename)
+with open(late_filename, 'wb') as f:
+    f.write(b'edited')
+late_ts = os.stat(late_filename).st_mtime_ns + 1_000_000_000
+os.utime(late_filename, ns=(late_ts, late_ts))
+
+exitcode = winshatag.reportFile(result)
+assert exitcode == 0
+assert winshatag.getStoredSha256(late_filename) == None
+assert os.stat(late_filename).st_mtime_ns == late_ts
+
+os.unlink(late_filename)
+
+print("*** Checking several files at once ***")
+other_filename = 'bar.txt'
+
+try:
+    os.unlink(other_filename)
+except FileNotFoundError:
+    pass
+
+open(other_filename, 'w').close()
+
+exitcode = winshatag.main([other_filename, filename])
+assert exitcode == 5
+assert winshatag.getStoredSha256(
+    other_filename) == 'e3b0c44298fc1c149afbf4c8996fb92427ae41e4649b934ca495991b7852b855'
+
+print("*** Checking a missing file among others ***")
+missing_filename = 'missing.txt'
+new_filename = 'qux.txt'
+
+for name in (missing_filename, new_filename):
+    try:
+        os.unlink(name)
+    except FileNotFoundError:
+        pass
+
+open(new_filename, 'w').close()
+
+exitcode = winshatag.main([missing_filename, new_filename])
+assert exitcode == 3
+assert winshatag.getStoredSha256(
+    new_filename) == 'e3b0c44298fc1c149afbf4c8996fb92427ae41e4649b934ca495991b7852b855'
+
+os.unlink(new_filename)
+
+print("*** Checking a file with a damaged tag among others ***")
+damaged_filename = 'damaged.txt'
+
+for name in (damaged_filename, new_filename):
+    try:
+        os.unlink(name)
+    except FileNotFoundError:
+        pass
+
+open(damaged_filename, 'w').close()
+open(new_filename, 'w').close()
+with open(damaged_filename + ':shatag.ts:$DATA', 'wb') as f:
+    f.write(b'garbage')
+
+exitcode = winshatag.main([damaged_filename, new_filename])
+assert exitcode == 3
+assert winshatag.getStoredSha256(
+    new_filename) == 'e3b0c44298fc1c149afbf4c8996fb92427ae41e4649b934ca495991b7852b855'
+
+os.unlink(damaged_filename)
+os.unlink(new_filename)
+
+print("*** Checking files with a tag cache ***")
+cache_filename = 'tags.db'
+
+try:
+    os.unlink(cache_filename)
+except FileNotFoundError:
+    pass
+
+exitcode = winshatag.main(['--cache', cache_filename, other_filename])
+assert exitcode == 0
+
+# Make the stored checksum wrong without touching the modification date. A
+# cache hit doesn't read the streams, so the file still checks out.
+other_ts = os.stat(other_filename).st_mtime_ns
+other_sha256 = winshatag.getStoredSha256(other_filename)
+winshatag.writeSha256(other_filename, 'ff' * 32)
+os.utime(other_filename, ns=(other_ts, other_ts))
+
+exitcode = winshatag.main(['--cache', cache_filename, other_filename])
+assert exitcode == 0
+exitcode = winshatag.main([other_filename])
+assert exitcode == 5
+
+winshatag.writeSha256(other_filename, other_sha256)
+winshatag.writeTimestamp(other_filename, other_ts)
+
+exitcode = winshatag.main(['--cache', cache_filename, filename])
+assert exitcode == 5
+
+try:
+    import blake3
+except ImportError:
+    blake3 = None
+
+if blake3 is not None:
+    print("*** Tagging file with blake3 ***")
+    exitcode = winshatag.main(['--algo', 'blake3', other_filename])
+    assert exitcode == 0
+    assert winshatag.getStoredHash(
+        other_filename, 'blake3') == 'af1349b9f5f9a1a6a0404dea36dcc9499bcb25c9adc112b7cc9a93cae41f3262'
+
+    print("*** Switching algorithms after modifying file ***")
+    switch_filename = 'baz.txt'
+
+    with open(switch_filename, 'wb') as f:
+        f.write(bytes(range(100)))
+
+    exitcode = winshatag.main([switch_filename])
+    assert exitcode == 0
+
+    with open(switch_filename, 'wb') as f:
+        f.write(bytes(range(0, 200, 2)))
+    ts = 1909669684252460189
+    os.utime(switch_filename, ns=(ts, ts))
+
+    exitcode = winshatag.main(['--algo', 'blake3', switch_filename])
+    assert exitcode == 0
+    # The sha256 tag is outdated, not corrupt.
+    exitcode = winshatag.main([switch_filename])
+    assert exitcode == 0
+    assert winshatag.getStoredSha256(
+        switch_filename) == winshatag.getActualSha256(switch_filename)
+
+    os.unlink(switch_filename)
+
 print("Tests passed.")
 
 os.unlink('foo.txt')
+os.unlink('bar.txt')
+os.unlink('tags.db')
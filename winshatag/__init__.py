@@ -19,51 +19,151 @@
 # SOFTWARE.
 
 import argparse
+import collections
+import concurrent.futures
+import contextlib
 import os
 import hashlib
+import mmap
+import queue
 import sys
+import threading
 
+from .cache import TagCache
 from .win32 import Win32File
 
-CHUNK_SIZE = 4096 * 2
+CHUNK_SIZE = 1024 * 1024
+
+# Files larger than this are read in chunks on a separate thread rather than
+# mapped, so that disk reads overlap with hashing.
+MMAP_MAX_SIZE = 64 * 1024 * 1024
+
+# O_SEQUENTIAL makes the CRT open the file with FILE_FLAG_SEQUENTIAL_SCAN,
+# which tells the cache manager to read ahead aggressively.
+READ_FLAGS = os.O_RDONLY | os.O_BINARY | os.O_SEQUENTIAL
 
 NANOSECONDS_IN_A_SECOND = 1_000_000_000
 
+# Our streams hold at most a hex digest or a timestamp.
+STREAM_MAX_SIZE = 128
+
+# Each algorithm's digest is kept in its own shatag.<algorithm> stream, along
+# with the modification date it was computed for, so that tagging a file with
+# one algorithm never makes another algorithm's digest look current.
+ALGORITHMS = ('sha256', 'blake3')
+
+
+def timestampStream(algorithm):
+    # sha256 keeps the stream name shatag and cshatag use.
+    if algorithm == 'sha256':
+        return 'shatag.ts'
+    return 'shatag.' + algorithm + '.ts'
+
 
 def formatTimestamp(time_ns):
     if time_ns == None:
         return None
 
-    seconds = time_ns // NANOSECONDS_IN_A_SECOND
-    nanoseconds = time_ns % NANOSECONDS_IN_A_SECOND
-    return "{0}.{1:09d}".format(seconds, nanoseconds)
+    return "%d.%09d" % divmod(time_ns, NANOSECONDS_IN_A_SECOND)
 
 
-def getStoredSha256(filename):
+def encodeTimestamp(time_ns):
+    """
+    Encodes a timestamp the way it's stored in the shatag.ts stream.
+    """
+    return b"%d.%09d" % divmod(time_ns, NANOSECONDS_IN_A_SECOND)
+
+
+def parseTimestamp(data):
+    """
+    Parses a timestamp read from the shatag.ts stream.
+    """
+    seconds, _, nanoseconds = data.partition(b'.')
+    return int(seconds) * NANOSECONDS_IN_A_SECOND + int(nanoseconds)
+
+
+def readStream(filename, stream):
+    """
+    Reads a small NTFS alternate data stream, or returns None if the stream
+    doesn't exist.
+
+    This goes straight to the CRT instead of through open(), since we don't
+    need the io module's buffering and text decoding for a few bytes.
+    """
     try:
-        with open(filename + ':shatag.sha256:$DATA', 'r') as f:
-            return f.read().lower()
+        fd = os.open(filename + ':' + stream + ':$DATA',
+                     os.O_RDONLY | os.O_BINARY)
     except FileNotFoundError:
         return None
+    try:
+        return os.read(fd, STREAM_MAX_SIZE)
+    finally:
+        os.close(fd)
 
 
-def getStoredTimestamp(filename):
+def readStreamOf(f, stream):
+    """
+    Like readStream, but opens the stream relative to an open Win32File.
+    """
     try:
-        with open(filename + ':shatag.ts:$DATA', 'r') as f:
-            seconds, nanoseconds = tuple(map(int, f.read().split('.')))
-            return seconds * NANOSECONDS_IN_A_SECOND + nanoseconds
+        with f.open_stream(stream) as s:
+            return s.read(STREAM_MAX_SIZE)
     except FileNotFoundError:
         return None
 
 
+def parseHash(data):
+    """
+    Parses a checksum as written by writeHash, i.e. as the lowercase hex
+    digest, the same format hashlib's hexdigest() returns.
+    """
+    return data.strip().decode('ascii')
+
+
+def getStoredHash(filename, algorithm):
+    data = readStream(filename, 'shatag.' + algorithm)
+    if data is None:
+        return None
+    return parseHash(data)
+
+
+def getStoredSha256(filename):
+    return getStoredHash(filename, 'sha256')
+
+
+def getStoredTimestamp(filename, algorithm='sha256'):
+    data = readStream(filename, timestampStream(algorithm))
+    if data is None:
+        return None
+    return parseTimestamp(data)
+
+
+def readStoredMetadata(filename, algorithm='sha256'):
+    """
+    Returns the stored checksum and timestamp.
+
+    The file is opened once and both streams are opened relative to it, so
+    its path is only parsed once.
+    """
+    with Win32File(filename, 'rb') as f:
+        hash_data = readStreamOf(f, 'shatag.' + algorithm)
+        ts_data = readStreamOf(f, timestampStream(algorithm))
+    return (None if hash_data is None else parseHash(hash_data),
+            None if ts_data is None else parseTimestamp(ts_data))
+
+
+def writeHash(filename, algorithm, digest):
+    with Win32File(filename + ':shatag.' + algorithm + ':$DATA', 'wb') as f:
+        return f.write_small(digest.encode('ascii'))
+
+
 def writeSha256(filename, sha256):
-    with Win32File(filename + ':shatag.sha256:$DATA', 'wb') as f:
-        return f.write(sha256.encode('ascii'))
+    return writeHash(filename, 'sha256', sha256)
 
 
-def writeTimestamp(filename, time_ns):
-    with Win32File(filename + ':shatag.ts:$DATA', 'wb') as f:
-        f.write(formatTimestamp(time_ns).encode('ascii'))
+def writeTimestamp(filename, time_ns, algorithm='sha256'):
+    with Win32File(filename + ':' + timestampStream(algorithm) + ':$DATA', 'wb') as f:
+        f.write_small(encodeTimestamp(time_ns))
         f.touch(time_ns)
 
 
@@ -72,69 +172,259 @@ def getActualTimestamp(filename):
     return result.st_mtime_ns
 
 
+def updateHashFromFile(hash, f):
+    """
+    Feeds the rest of the file into the hash.
+
+    A reader thread fills one buffer while the calling thread hashes the
+    other. hashlib releases the GIL while hashing large buffers, so reading
+    from disk and hashing overlap instead of taking turns.
+    """
+    free = queue.Queue()
+    full = queue.Queue()
+    for _ in range(2):
+        free.put(memoryview(bytearray(CHUNK_SIZE)))
+
+    def reader():
+        try:
+            while (view := free.get()) is not None:
+                n = f.readinto(view)
+                full.put((view, n, None))
+                if n == 0:
+                    break
+        except BaseException as e:
+            full.put((None, 0, e))
+
+    thread = threading.Thread(target=reader, daemon=True)
+    thread.start()
+    try:
+        while True:
+            view, n, error = full.get()
+            if error is not None:
+                raise error
+            if n == 0:
+                break
+            hash.update(view[:n])
+            free.put(view)
+    finally:
+        # Unblock the reader in case we're bailing out early.
+        free.put(None)
+        thread.join()
+
+
+def newHash(algorithm):
+    if algorithm == 'sha256':
+        # hashlib is backed by OpenSSL, which already picks a SHA-NI kernel
+        # at runtime when the CPU supports it.
+        return hashlib.sha256()
+    elif algorithm == 'blake3':
+        # Optional dependency, so only import it when asked to.
+        import blake3
+        return blake3.blake3()
+    else:
+        raise NotImplementedError(f'algorithm {algorithm}')
+
+
+def getActualHash(filename, algorithm):
+    # Keep Python out of the loop: small files are mapped and hashed in a
+    # single update() call, large files are hashed while the next chunk is
+    # being read.
+    hash = newHash(algorithm)
+    with open(os.open(filename, READ_FLAGS), 'rb', buffering=0) as f:
+        mm = None
+        # Empty files can't be mapped.
+        if 0 < os.fstat(f.fileno()).st_size <= MMAP_MAX_SIZE:
+            try:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except OSError:
+                # Some files (e.g. on network shares) refuse to be mapped.
+                pass
+        if mm is None:
+            updateHashFromFile(hash, f)
+        else:
+            with mm, memoryview(mm) as view:
+                hash.update(view)
+    return hash.hexdigest()
+
+
 def getActualSha256(filename):
-    hash = hashlib.sha256()
-    with open(filename, 'rb') as f:
-        while chunk := f.read(CHUNK_SIZE):
-            hash.update(chunk)
-    return hash.hexdigest().lower()
+    return getActualHash(filename, 'sha256')
 
 
 parser = argparse.ArgumentParser(
     description='Detects silent data changes by storing the file\'s checksum and modification date into NTFS ADS.')
-parser.add_argument("filename", metavar='FILE', help='file to checksum')
+parser.add_argument("filenames", metavar='FILE',
+                    nargs='+', help='files to checksum')
+parser.add_argument("--trust-mtime", action='store_true',
+                    help='skip checksumming files whose modification date matches the stored one')
+parser.add_argument("--cache", metavar='DB',
+                    help='remember tags in an SQLite database to skip reading them from unmodified files')
+parser.add_argument("--algo", choices=ALGORITHMS, default='sha256',
+                    help='checksum algorithm; blake3 is much faster but requires the blake3 package (default: sha256)')
 
 
-def main(argv=None):
-    args = parser.parse_args(argv)
+ScanResult = collections.namedtuple('ScanResult', (
+    'filename', 'algorithm', 'stat', 'stored_hash', 'stored_ts', 'actual_hash', 'actual_ts', 'modified'))
 
-    if args.filename == []:
-        parser.print_usage()
-        return 1
 
-    filename = os.path.abspath(args.filename)
+def scanFile(filename, trust_mtime=False, algorithm='sha256', cache=None):
+    """
+    Gathers the stored and actual state of a file.
+
+    This doesn't print or write anything, so it can run for several files at
+    once. actual_hash is None if the file was skipped because of trust_mtime,
+    and modified is True if the file changed while it was being hashed.
 
-    stored_ts = getStoredTimestamp(filename)
-    stored_sha256 = getStoredSha256(filename)
-    actual_ts = getActualTimestamp(filename)
-    actual_sha256 = getActualSha256(filename)
+    The cache is only read here; reportFile updates it.
+    """
+    filename = os.path.abspath(filename)
+
+    stat = os.stat(filename)
+    actual_ts = stat.st_mtime_ns
+
+    cached_hash = cache.lookup(filename, stat, algorithm) if cache is not None else None
+    if cached_hash is not None:
+        # The streams were written together with the cache entry, and the
+        # file hasn't been modified since.
+        stored_hash, stored_ts = cached_hash, actual_ts
+    else:
+        stored_hash, stored_ts = readStoredMetadata(filename, algorithm)
+
+    if trust_mtime and stored_ts == actual_ts and stored_hash is not None:
+        # The file hasn't been modified since it was last tagged, and we
+        # were told not to look for silent corruption.
+        return ScanResult(filename, algorithm, stat, stored_hash, stored_ts, None, actual_ts, False)
+
+    actual_hash = getActualHash(filename, algorithm)
+    modified = getActualTimestamp(filename) != actual_ts
+    return ScanResult(filename, algorithm, stat, stored_hash, stored_ts, actual_hash, actual_ts, modified)
+
+
+def reportFile(result, cache=None):
+    filename, algorithm, stat, stored_hash, stored_ts, actual_hash, actual_ts, modified = result
+
+    if actual_hash is None:
+        print("<ok>", filename)
+        if cache is not None:
+            cache.store(filename, stat, algorithm, stored_hash)
+        return 0
+
+    if modified:
+        # The file was modified while we were reading it, so the hash doesn't
+        # belong to either timestamp. Leave the stored values alone.
+        print("Error: file modified while reading", filename, file=sys.stderr)
+        return 0
 
     must_update = False
     is_corrupt = False
 
-    if stored_ts == actual_ts:
+    if stored_ts == actual_ts and stored_hash is not None:
         # Modified timestamps are the same.
         # Compare the hash.
-        if stored_sha256 != actual_sha256:
+        if stored_hash != actual_hash:
             # Hashes are different.
-            # Perhaps the file was modified while we were reading it
-            actual_ts = getActualTimestamp(filename)
-            if stored_ts == actual_ts:
-                print("Error: corrupt file", filename, file=sys.stderr)
-                print("<corrupt>", filename)
-                print(" stored:", stored_sha256, formatTimestamp(stored_ts))
-                print(" actual:", actual_sha256, formatTimestamp(actual_ts))
-                is_corrupt = True
-                # must_update = True
+            print("Error: corrupt file", filename, file=sys.stderr)
+            print("<corrupt>", filename)
+            print(" stored:", stored_hash, formatTimestamp(stored_ts))
+            print(" actual:", actual_hash, formatTimestamp(actual_ts))
+            is_corrupt = True
+            # must_update = True
         else:
             # Hashes are the same.
             print("<ok>", filename)
+            if cache is not None:
+                cache.store(filename, stat, algorithm, actual_hash)
     else:
-        # Modified timestamps are different.
+        # Modified timestamps are different, or the file was never tagged
+        # with this algorithm.
+
+        # The result may have waited a while to be reported, e.g. behind a
+        # large file given earlier on the command line. Make sure the file
+        # hasn't been modified since, or we'd tag the edit with the old hash
+        # and set its modification date back.
+        try:
+            modified = getActualTimestamp(filename) != actual_ts
+        except OSError as e:
+            print("Error: could not read file", filename, e, file=sys.stderr)
+            return 3
+        if modified:
+            print("Error: file modified while reading", filename, file=sys.stderr)
+            return 0
+
         print("<outdated>", filename)
-        print(" stored:", stored_sha256, formatTimestamp(stored_ts))
-        print(" actual:", actual_sha256, formatTimestamp(actual_ts))
+        print(" stored:", stored_hash, formatTimestamp(stored_ts))
+        print(" actual:", actual_hash, formatTimestamp(actual_ts))
         must_update = True
 
     if must_update:
         try:
-            writeSha256(filename, actual_sha256)
-            writeTimestamp(filename, actual_ts)
+            writeHash(filename, algorithm, actual_hash)
+            writeTimestamp(filename, actual_ts, algorithm)
         except Exception as e:
             print("Error: could not write NTFS ADS to file", filename, e)
             return 4
+        if cache is not None:
+            cache.store(filename, stat, algorithm, actual_hash)
 
     if is_corrupt:
         return 5
     else:
         return 0
+
+
+def checkFile(filename, trust_mtime=False, algorithm='sha256', cache=None):
+    return reportFile(scanFile(filename, trust_mtime, algorithm, cache), cache)
+
+
+def main(argv=None):
+    args = parser.parse_args(argv)
+
+    if args.filenames == []:
+        parser.print_usage()
+        return 1
+
+    try:
+        newHash(args.algo)
+    except ImportError:
+        parser.error(f'--algo {args.algo} requires the {args.algo} package')
+
+    # Files are read and hashed on a thread pool (see updateHashFromFile for
+    # why threads help). Results are reported in order on this thread, so the
+    # output stays readable and the streams are written one file at a time.
+    #
+    # Keep going after a failure so that one bad file doesn't hide the state
+    # of the others, and report the most severe result.
+    exitcode = 0
+    max_workers = min(32, (os.cpu_count() or 1) * 2)
+    with contextlib.ExitStack() as stack:
+        cache = None
+        if args.cache is not None:
+            cache = stack.enter_context(TagCache(args.cache))
+        executor = stack.enter_context(
+            concurrent.futures.ThreadPoolExecutor(max_workers))
+        futures = [executor.submit(scanFile, filename, args.trust_mtime, args.algo, cache)
+                   for filename in args.filenames]
+        try:
+            for filename, future in zip(args.filenames, futures):
+                try:
+                    result = future.result()
+                except OSError as e:
+                    print("Error: could not read file",
+                          os.path.abspath(filename), e, file=sys.stderr)
+                    exitcode = max(exitcode, 3)
+                    continue
+                except ValueError as e:
+                    # The stored tag can't be parsed, e.g. because something
+                    # else wrote to the stream.
+                    print("Error: damaged NTFS ADS in file",
+                          os.path.abspath(filename), e, file=sys.stderr)
+                    exitcode = max(exitcode, 3)
+                    continue
+                exitcode = max(exitcode, reportFile(result, cache))
+        except BaseException:
+            # Don't hash every queued file before giving up, e.g. on Ctrl-C.
+            # Files already being hashed still run to completion.
+            for future in futures:
+                future.cancel()
+            raise
+    return exitcode
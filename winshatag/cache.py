@@ -0,0 +1,114 @@
+# Copyright (c) 2021 Gabriel Soldani
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+This module keeps a cache of file tags in an SQLite database.
+
+Reading the tags out of a file's alternate data streams takes two opens per
+file. The cache remembers, for each file, the modification date and size it
+had when it was last tagged along with the digest, keyed by the volume serial
+number and file index that os.stat reports on Windows. When a file's date and
+size still match its entry, the entry holds the same values as the streams,
+so they don't need to be read.
+
+The streams remain the source of truth: any change that would make them
+disagree with the cache also changes the file's modification date. That only
+holds if the file index identifies the file, so files on file systems without
+stable file indexes (e.g. FAT, or network shares that report 0) are never
+cached.
+"""
+
+import sqlite3
+
+from .win32 import get_file_system_name
+
+# File systems whose file indexes stay the same for the life of a file.
+STABLE_FILE_INDEX_FILE_SYSTEMS = ('NTFS', 'ReFS')
+
+
+class TagCache(object):
+    def __init__(self, filename):
+        self._connection = sqlite3.connect(filename)
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS tags ('
+            'volume TEXT, file TEXT, algorithm TEXT, '
+            'mtime_ns INTEGER, size INTEGER, digest TEXT, '
+            'PRIMARY KEY (volume, file, algorithm))'
+        )
+        # Load everything up front so that lookups don't touch the
+        # connection, which may only be used from the thread that opened it.
+        self._tags = {
+            (volume, file, algorithm): (mtime_ns, size, digest)
+            for volume, file, algorithm, mtime_ns, size, digest in self._connection.execute(
+                'SELECT volume, file, algorithm, mtime_ns, size, digest FROM tags')
+        }
+        # Whether each volume seen so far has stable file indexes.
+        self._stable_volumes = {}
+
+    def _cacheable(self, filename, stat):
+        if stat.st_ino == 0:
+            return False
+        stable = self._stable_volumes.get(stat.st_dev)
+        if stable is None:
+            try:
+                stable = get_file_system_name(filename) in STABLE_FILE_INDEX_FILE_SYSTEMS
+            except OSError:
+                stable = False
+            self._stable_volumes[stat.st_dev] = stable
+        return stable
+
+    @staticmethod
+    def _key(stat, algorithm):
+        # File indexes are 64 bits wide on NTFS and 128 bits wide on ReFS,
+        # which doesn't fit in an SQLite INTEGER.
+        return (str(stat.st_dev), str(stat.st_ino), algorithm)
+
+    def lookup(self, filename, stat, algorithm):
+        """
+        Returns the cached digest for the file, or None if the file isn't
+        cached or has changed since it was.
+        """
+        if not self._cacheable(filename, stat):
+            return None
+        tag = self._tags.get(self._key(stat, algorithm))
+        if tag is None:
+            return None
+        mtime_ns, size, digest = tag
+        if mtime_ns != stat.st_mtime_ns or size != stat.st_size:
+            return None
+        return digest
+
+    def store(self, filename, stat, algorithm, digest):
+        if not self._cacheable(filename, stat):
+            return
+        key = self._key(stat, algorithm)
+        tag = (stat.st_mtime_ns, stat.st_size, digest)
+        if self._tags.get(key) == tag:
+            return
+        self._tags[key] = tag
+        self._connection.execute(
+            'INSERT OR REPLACE INTO tags VALUES (?, ?, ?, ?, ?, ?)', key + tag)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self._connection.commit()
+        self._connection.close()
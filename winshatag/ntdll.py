@@ -0,0 +1,138 @@
+# Copyright (c) 2021 Gabriel Soldani
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+This module is a wrapper for the few Native API file functions we need.
+
+Opening an alternate data stream by path makes the object manager parse the
+whole path again, once for every stream. NtCreateFile can instead open a
+stream relative to a handle to its file, in which case only the stream name
+is parsed.
+"""
+
+from ctypes import WinDLL, WinError, Structure, POINTER, pointer, byref, sizeof, c_long, c_size_t
+from ctypes.wintypes import HANDLE, ULONG, USHORT, LPWSTR, LPVOID, PHANDLE, PLARGE_INTEGER
+NTSTATUS = c_long
+ACCESS_MASK = ULONG
+NULL = None
+
+
+class UNICODE_STRING(Structure):
+    _fields_ = (
+        ('Length', USHORT),
+        ('MaximumLength', USHORT),
+        ('Buffer', LPWSTR),
+    )
+
+
+class OBJECT_ATTRIBUTES(Structure):
+    _fields_ = (
+        ('Length', ULONG),
+        ('RootDirectory', HANDLE),
+        ('ObjectName', POINTER(UNICODE_STRING)),
+        ('Attributes', ULONG),
+        ('SecurityDescriptor', LPVOID),
+        ('SecurityQualityOfService', LPVOID),
+    )
+
+
+class IO_STATUS_BLOCK(Structure):
+    _fields_ = (
+        # Actually a union of NTSTATUS Status and PVOID Pointer.
+        ('Status', LPVOID),
+        ('Information', c_size_t),
+    )
+
+
+ntdll = WinDLL('ntdll')
+
+NtCreateFile = ntdll.NtCreateFile
+NtCreateFile.restype = NTSTATUS
+NtCreateFile.argtypes = (
+    PHANDLE,
+    ACCESS_MASK,
+    POINTER(OBJECT_ATTRIBUTES),
+    POINTER(IO_STATUS_BLOCK),
+    PLARGE_INTEGER,
+    ULONG,
+    ULONG,
+    ULONG,
+    ULONG,
+    LPVOID,
+    ULONG,
+)
+
+RtlNtStatusToDosError = ntdll.RtlNtStatusToDosError
+RtlNtStatusToDosError.restype = ULONG
+RtlNtStatusToDosError.argtypes = (
+    NTSTATUS,
+)
+
+SYNCHRONIZE = 0x00100000
+
+OBJ_CASE_INSENSITIVE = 0x40
+
+FILE_OPEN = 1
+
+FILE_SYNCHRONOUS_IO_NONALERT = 0x20
+FILE_NON_DIRECTORY_FILE = 0x40
+
+
+def open_relative(root, name, desired_access, share_access):
+    """
+    Opens an existing file relative to the root handle, e.g. one of its
+    alternate data streams when name is ':stream:$DATA'.
+
+    The handle is opened for synchronous I/O, so it can be used with ReadFile
+    and WriteFile like one returned by CreateFileW.
+
+    Reference: https://docs.microsoft.com/en-us/windows/win32/api/winternl/nf-winternl-ntcreatefile
+    """
+    # Length is in bytes and doesn't include a terminating NUL.
+    length = len(name.encode('utf-16-le'))
+    object_name = UNICODE_STRING(length, length, name)
+    object_attributes = OBJECT_ATTRIBUTES(
+        sizeof(OBJECT_ATTRIBUTES),
+        root,
+        pointer(object_name),
+        OBJ_CASE_INSENSITIVE,
+        NULL,
+        NULL
+    )
+    io_status_block = IO_STATUS_BLOCK()
+    hFile = HANDLE()
+
+    status = NtCreateFile(
+        byref(hFile),
+        desired_access | SYNCHRONIZE,
+        byref(object_attributes),
+        byref(io_status_block),
+        NULL,
+        0,
+        share_access,
+        FILE_OPEN,
+        FILE_SYNCHRONOUS_IO_NONALERT | FILE_NON_DIRECTORY_FILE,
+        NULL,
+        0
+    )
+    if status < 0:
+        raise WinError(RtlNtStatusToDosError(status))
+
+    return hFile.value
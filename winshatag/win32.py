@@ -34,8 +34,11 @@ import os
 from datetime import datetime, time
 from typing import Union
 
-from ctypes import WinDLL, get_last_error, WinError, create_string_buffer, sizeof, byref, c_char
-from ctypes.wintypes import LPCWSTR, DWORD, LPVOID, HANDLE, BOOL, LPCVOID, LPDWORD, LPFILETIME, FILETIME
+from ctypes import WinDLL, get_last_error, WinError, sizeof, byref, c_char, addressof, create_unicode_buffer
+from ctypes.wintypes import LPCWSTR, LPWSTR, DWORD, LPVOID, HANDLE, BOOL, LPCVOID, LPDWORD, LPFILETIME, FILETIME
+
+from .ntdll import open_relative
+
 LPSECURITY_ATTRIBUTES = LPVOID
 LPOVERLAPPED = LPVOID
 NULL = None
@@ -116,9 +119,53 @@ SetFileTime.argtypes = (
     LPFILETIME,
 )
 
+MAX_PATH = 260
+
+GetVolumePathNameW = kernel32.GetVolumePathNameW
+GetVolumePathNameW.restype = BOOL
+GetVolumePathNameW.argtypes = (
+    LPCWSTR,
+    LPWSTR,
+    DWORD,
+)
+
+GetVolumeInformationW = kernel32.GetVolumeInformationW
+GetVolumeInformationW.restype = BOOL
+GetVolumeInformationW.argtypes = (
+    LPCWSTR,
+    LPWSTR,
+    DWORD,
+    LPDWORD,
+    LPDWORD,
+    LPDWORD,
+    LPWSTR,
+    DWORD,
+)
+
+
+def get_file_system_name(filename):
+    """
+    Returns the name of the file system the file is on, e.g. 'NTFS'.
+
+    Reference: https://docs.microsoft.com/en-us/windows/win32/api/fileapi/nf-fileapi-getvolumeinformationw
+    """
+    volume_path = create_unicode_buffer(max(len(filename) + 1, MAX_PATH))
+    if GetVolumePathNameW(filename, volume_path, len(volume_path)) == FALSE:
+        raise WinError(get_last_error())
+
+    file_system_name = create_unicode_buffer(MAX_PATH + 1)
+    if GetVolumeInformationW(volume_path, NULL, 0, NULL, NULL, NULL, file_system_name, len(file_system_name)) == FALSE:
+        raise WinError(get_last_error())
+
+    return file_system_name.value
+
 
 __NANOSECONDS_BETWEEN_EPOCHS = 11644473600 * 1000000000
 
+# The same offset in FILETIME units, so that conversions only need a single
+# multiplication or division by 100.
+__INTERVALS_BETWEEN_EPOCHS = __NANOSECONDS_BETWEEN_EPOCHS // 100
+
 
 def FILETIME_to_time_ns(filetime):
     """
@@ -129,8 +176,8 @@ def FILETIME_to_time_ns(filetime):
 
     Reference: https://docs.microsoft.com/en-us/windows/win32/api/minwinbase/ns-minwinbase-filetime
     """
-    filetime = (filetime.dwLowDateTime | (filetime.dwHighDateTime << 32))
-    return filetime * 100 - __NANOSECONDS_BETWEEN_EPOCHS
+    intervals = (filetime.dwHighDateTime << 32) | filetime.dwLowDateTime
+    return (intervals - __INTERVALS_BETWEEN_EPOCHS) * 100
 
 
 def time_ns_to_FILETIME(time_ns):
@@ -142,13 +189,39 @@ def time_ns_to_FILETIME(time_ns):
 
     Reference: https://docs.microsoft.com/en-us/windows/win32/api/minwinbase/ns-minwinbase-filetime
     """
-    filetime = (time_ns + __NANOSECONDS_BETWEEN_EPOCHS) // 100
-    return FILETIME(filetime & 0xFFFFFFFF, filetime >> 32)
+    high, low = divmod(time_ns // 100 + __INTERVALS_BETWEEN_EPOCHS, 1 << 32)
+    return FILETIME(low, high)
+
+
+def extended_length_path(filename):
+    r"""
+    Converts an absolute path to an extended-length path.
+
+    CreateFileW passes paths prefixed with \\?\ to NTFS as-is, skipping the
+    Win32 path normalization and the MAX_PATH limit. Since that also means
+    the path must already be normalized, we normalize it ourselves. Relative
+    paths, device paths (\\.\) and paths that already have the prefix are
+    returned unchanged.
+
+    Reference: https://docs.microsoft.com/en-us/windows/win32/fileio/naming-a-file#maximum-path-length-limitation
+    """
+    if filename[:4].replace('/', '\\') in ('\\\\?\\', '\\\\.\\'):
+        # Already an extended-length or device path.
+        return filename
+    drive, _ = os.path.splitdrive(filename)
+    if drive[:2].replace('/', '\\') == '\\\\':
+        return '\\\\?\\UNC\\' + os.path.normpath(filename)[2:]
+    if len(drive) == 2 and filename[2:3] in ('\\', '/'):
+        return '\\\\?\\' + os.path.normpath(filename)
+    return filename
+
+
+READ_BUFFER_SIZE = 64 * 1024
 
 
 class Win32File(object):
     def __init__(self, filename, mode):
-        filename = os.path.abspath(str(filename))
+        filename = extended_length_path(str(filename))
         if mode == 'rb':
             hFile = CreateFileW(
                 filename,
@@ -175,31 +248,94 @@ class Win32File(object):
         if hFile == INVALID_HANDLE_VALUE:
             raise WinError(get_last_error())
 
-        self._hFile = hFile
+        self._attach(hFile)
 
-    def read(self):
-        bytearr = bytearray()
-        bytes_read = DWORD(0)
-        buf = create_string_buffer(4096)
-        while True:
-            if ReadFile(self._hFile, buf, sizeof(buf), byref(bytes_read), NULL) == FALSE:
+    @classmethod
+    def from_handle(cls, hFile):
+        """
+        Wraps an already open handle, which will be closed on __exit__.
+        """
+        self = cls.__new__(cls)
+        self._attach(hFile)
+        return self
+
+    def _attach(self, hFile):
+        self._hFile = hFile
+        # Reused by every ReadFile/WriteFile call on this handle, so the loops
+        # don't allocate a DWORD and a byref() each time.
+        self._bytes_read = DWORD(0)
+        self._bytes_read_ref = byref(self._bytes_read)
+        self._bytes_written = DWORD(0)
+        self._bytes_written_ref = byref(self._bytes_written)
+
+    def read(self, size=-1) -> bytes:
+        """
+        Reads up to size bytes, or the rest of the file if size is negative.
+
+        Returns an immutable bytes object; callers that need to modify the
+        data can wrap it in a bytearray.
+        """
+        # Bind everything the loop touches to locals, so each iteration does
+        # LOAD_FAST instead of global and attribute lookups.
+        _ReadFile, _FALSE = ReadFile, FALSE
+        hFile, bytes_read, bytes_read_ref = self._hFile, self._bytes_read, self._bytes_read_ref
+        chunks = []
+        append = chunks.append
+        # Slice the raw array rather than .value, which stops at the first NUL.
+        # Small reads get a buffer of just the right size.
+        buf = (c_char * (READ_BUFFER_SIZE if size < 0 else min(size, READ_BUFFER_SIZE)))()
+        remaining = size
+        while remaining != 0:
+            to_read = sizeof(buf) if remaining < 0 else min(remaining, sizeof(buf))
+            if _ReadFile(hFile, buf, to_read, bytes_read_ref, NULL) == _FALSE:
                 raise WinError(get_last_error())
             if bytes_read.value == 0:
                 break
-            buf.value[0:bytes_read.value]
-            bytearr.extend(buf.value[:bytes_read.value])
-        return bytearr
+            append(buf[:bytes_read.value])
+            if remaining > 0:
+                remaining -= bytes_read.value
+        return b"".join(chunks)
 
     def write(self, data: Union[bytes, bytearray]):
-        bytearr = bytearray(data)
-        bytes_written = DWORD(0)
-        while True:
-            chararr = (c_char*len(bytearr)).from_buffer(bytearr)
-            if WriteFile(self._hFile, chararr, len(bytearr), byref(bytes_written), None) == FALSE:
+        # See read().
+        _WriteFile, _FALSE = WriteFile, FALSE
+        hFile, bytes_written, bytes_written_ref = self._hFile, self._bytes_written, self._bytes_written_ref
+        chararr = (c_char*len(data)).from_buffer_copy(data)
+        address = addressof(chararr)
+        size = len(chararr)
+        offset = 0
+        while offset < size:
+            if _WriteFile(hFile, address + offset, size - offset, bytes_written_ref, None) == _FALSE:
                 raise WinError(get_last_error())
-            bytearr = bytearr[bytes_written.value:]
-            if len(bytearr) == 0:
-                break
+            offset += bytes_written.value
+
+    def write_small(self, data: bytes):
+        """
+        Writes a few bytes with a single WriteFile call.
+
+        The bytes object is passed to WriteFile as-is instead of being copied
+        into a ctypes array first, which matters when the payload is only a
+        digest or a timestamp. Partial writes fall back to write().
+        """
+        if WriteFile(self._hFile, data, len(data), self._bytes_written_ref, None) == FALSE:
+            raise WinError(get_last_error())
+        if self._bytes_written.value < len(data):
+            self.write(data[self._bytes_written.value:])
+
+    def open_stream(self, stream):
+        """
+        Opens one of this file's alternate data streams for reading.
+
+        The stream is opened relative to this file's handle, so its path isn't
+        parsed again. Raises FileNotFoundError if the stream doesn't exist.
+        """
+        hFile = open_relative(
+            self._hFile,
+            ':' + stream + ':$DATA',
+            FILE_READ_DATA | FILE_READ_ATTRIBUTES,
+            FILE_SHARE_READ | FILE_SHARE_WRITE | FILE_SHARE_DELETE
+        )
+        return Win32File.from_handle(hFile)
 
     def get_mdate_ns(self):
         filetime = FILETIME(0xFFFFFFFF, 0xFFFFFFFF)